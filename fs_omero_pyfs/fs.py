@@ -10,94 +10,265 @@ from fs.errors import (
     DirectoryNotEmpty,
     FileExists,
     FileExpected,
+    FSError,
+    InvalidCharsInPath,
     RemoteConnectionError,
     RemoveRootError,
     ResourceError,
     ResourceNotFound,
 )
 from fs.info import Info
+from fs.path import (
+    abspath,
+    combine,
+    join,
+    normpath,
+)
 from fs.subfs import SubFS
+from fs.walk import (
+    BoundWalker,
+    Walker,
+)
 
+from collections import (
+    OrderedDict,
+    namedtuple,
+)
+from copy import copy
 from io import (
-    IOBase,
-    UnsupportedOperation,
+    BufferedRandom,
+    BufferedReader,
+    BufferedWriter,
+    RawIOBase,
 )
+import atexit
+import hashlib
+import hmac
+from functools import lru_cache
+from itertools import islice
 import logging
+import os
+from threading import (
+    Lock,
+    Timer,
+)
 from time import time
 import omero.clients
-from omero.gateway import (
-    BlitzGateway,
-    OriginalFileWrapper,
-    TagAnnotationWrapper,
-)
+from omero.gateway import BlitzGateway
 from omero.rtypes import (
+    rlong,
+    rstring,
     rtime,
     unwrap,
 )
 
 DEFAULT_NS = 'github.com/manics/fs-omero-pyfs'
+# Default maximum number of paths held in each path cache
+DEFAULT_CACHE_SIZE = 1024
+# Larger writes are split into chunks of this size to limit the size of each
+# Ice message
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+# Unused sessions are kept open for this many seconds so they can be reused by
+# another OmeroFS, 0 closes them immediately
+SESSION_POOL_TTL = 300
+# Maximum number of directories listed in a single query by walks
+QUERY_BATCH_SIZE = 500
+# Size of the buffer used by file objects returned by openbin
+BUFFER_SIZE = 1024 * 1024
 
+# HQL queries, all are restricted to the :ns namespace. HQL has no UNION so
+# directories and files are queried separately. Only the required columns
+# are projected instead of loading wrappers, the creation time requires a
+# join so it's only fetched if needed. For files the file is the parent in
+# the link.
+_Q_GET_ROOT_ID = (
+    'SELECT id FROM TagAnnotation WHERE ns=:ns AND textValue=:path')
+_Q_GET_DIR_ID = (
+    'SELECT child.id FROM AnnotationAnnotationLink '
+    'WHERE parent.id=:id '
+    'AND child.textValue=:basename '
+    'AND child.ns=:ns '
+    'AND child.class=TagAnnotation')
+_Q_GET_FILE_ID = (
+    'SELECT parent.id FROM OriginalFileAnnotationLink '
+    'WHERE parent.name=:filename '
+    'AND child.id=:id '
+    'AND child.ns=:ns '
+    'AND child.class=TagAnnotation')
 
-class OriginalFileObj(omero.gateway._OriginalFileAsFileObj, IOBase):
-    # https://docs.python.org/3.6/library/io.html#io.IOBase
-    # https://github.com/ome/omero-py/blob/v5.6.dev9/src/omero/gateway/__init__.py#L5293
+# Columns for OmeroFS._make_info
+_DIR_INFO_COLS = 'child.id, child.details.creationEvent.time'
+_FILE_INFO_COLS = (
+    'parent.id, parent.ctime, parent.mtime, parent.size, '
+    'parent.details.creationEvent.time')
 
-    def __init__(self, *args, **kwargs):
-        self._readable = kwargs.pop('readable', True)
-        self._writable = kwargs.pop('writable', True)
-        super().__init__(*args, **kwargs)
+_Q_RESOLVE_ROOT = (
+    'SELECT id, details.creationEvent.time FROM TagAnnotation '
+    'WHERE ns=:ns AND textValue=:path')
+_Q_RESOLVE_FILE = (
+    'SELECT ' + _FILE_INFO_COLS + ' '
+    'FROM OriginalFileAnnotationLink '
+    'WHERE parent.name=:basename '
+    'AND child.id=:id '
+    'AND child.ns=:ns '
+    'AND child.class=TagAnnotation')
+_Q_RESOLVE_DIR = (
+    'SELECT ' + _DIR_INFO_COLS + ' '
+    'FROM AnnotationAnnotationLink '
+    'WHERE parent.id=:id '
+    'AND child.textValue=:basename '
+    'AND child.ns=:ns '
+    'AND child.class=TagAnnotation')
 
-    def close(self):
-        super().close()
-        super(IOBase, self).close()
+# Directory listings, with or without the _make_info columns
+_LIST_DIRS = (
+    'SELECT {}, child.textValue '
+    'FROM AnnotationAnnotationLink '
+    'WHERE parent.id=:id AND child.id>:last AND child.ns=:ns '
+    'ORDER BY child.id')
+_LIST_FILES = (
+    'SELECT {}, parent.name '
+    'FROM OriginalFileAnnotationLink '
+    'WHERE child.id=:id AND parent.id>:last AND child.ns=:ns '
+    'ORDER BY parent.id')
+_Q_LIST_DIRS = _LIST_DIRS.format('child.id')
+_Q_LIST_FILES = _LIST_FILES.format('parent.id')
+_Q_LIST_DIRS_INFO = _LIST_DIRS.format(_DIR_INFO_COLS)
+_Q_LIST_FILES_INFO = _LIST_FILES.format(_FILE_INFO_COLS)
 
-    def fileno(self):
-        raise UnsupportedOperation('fileno not supported')
+_Q_WALK_DIRS = (
+    'SELECT parent.id, ' + _DIR_INFO_COLS + ', child.textValue '
+    'FROM AnnotationAnnotationLink '
+    'WHERE parent.id IN (:ids) AND child.ns=:ns '
+    'ORDER BY id')
+_Q_WALK_FILES = (
+    'SELECT child.id, ' + _FILE_INFO_COLS + ', parent.name '
+    'FROM OriginalFileAnnotationLink '
+    'WHERE child.id IN (:ids) AND child.ns=:ns '
+    'ORDER BY id')
 
-    def flush(self):
-        pass
 
-    def isatty(self):
-        return False
+# Characters that aren't allowed in paths
+INVALID_PATH_CHARS = '\0'
+
+
+@lru_cache(maxsize=4096)
+def _validatepath(path):
+    # The same checks as FS.validatepath for OmeroFS._meta. This is a module
+    # level function shared by all instances since a cache holding a bound
+    # method would keep its filesystem alive. Invalid paths raise so are
+    # never cached.
+    if isinstance(path, bytes):
+        raise TypeError('paths must be str (not bytes)')
+    if set(path).intersection(INVALID_PATH_CHARS):
+        raise InvalidCharsInPath(path)
+    return abspath(normpath(path))
+
+
+# Reference to a directory TagAnnotation
+TagRef = namedtuple('TagRef', 'id')
+
+
+class FileRef:
+    # Reference to an OriginalFile with the attributes of OriginalFileWrapper
+    # used by OriginalFileObj, creating a wrapper for an unloaded object would
+    # load it from the server
+
+    def __init__(self, conn, id):
+        self._conn = conn
+        self.id = id
+
+
+class OriginalFileObj(RawIOBase):
+    # Unbuffered file object for an OriginalFile, openbin wraps this in an
+    # io.BufferedReader, BufferedWriter or BufferedRandom which provide
+    # buffering, readline and iteration
+    # https://docs.python.org/3.6/library/io.html#io.RawIOBase
+    # Based on
+    # https://github.com/ome/omero-py/blob/v5.6.dev9/src/omero/gateway/__init__.py#L5293
+
+    # Maximum number of bytes requested from the server in a single read.
+    # This is the OMERO read-block size, the buffer of the io.Buffered* stream
+    # returned by openbin is BUFFER_SIZE unless openbin is passed buffering.
+    DEFAULT_BUFSIZE = 4 * 1024 * 1024
+    MIN_BUFSIZE = 1024 * 1024
+
+    def __init__(self, originalfile, readable=True, writable=True,
+                 bufsize=DEFAULT_BUFSIZE, size=None):
+        super().__init__()
+        self._readable = readable
+        self._writable = writable
+        self.bufsize = bufsize
+        # Don't use BlitzGateway.createRawFileStore as it always returns the
+        # same store
+        conn = originalfile._conn
+        self.rfs = conn.c.sf.createRawFileStore()
+        try:
+            self.rfs.setFileId(originalfile.id, conn.SERVICE_OPTS)
+        except Exception:
+            # Fails if the file doesn't exist, close the store so it isn't
+            # left open on the server
+            self.close()
+            raise
+        self.pos = 0
+        # File size, fetched when first needed unless passed in, and updated
+        # by write and truncate so the server isn't asked for it on every read
+        self._size = size
+
+    def _get_size(self):
+        if self._size is None:
+            self._size = self.rfs.size()
+        return self._size
+
+    def close(self):
+        if not self.closed:
+            self.rfs.close()
+        super().close()
 
     def seek(self, n, mode=Seek.set):
-        super().seek(n, mode)
+        if mode == Seek.set:
+            pos = n
+        elif mode == Seek.current:
+            pos = self.pos + n
+        elif mode == Seek.end:
+            pos = self._get_size() + n
+        else:
+            raise ValueError('Invalid seek mode: {}'.format(mode))
+        if pos < 0:
+            raise ValueError('Negative seek position {}'.format(pos))
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
         return self.pos
 
-    def read(self, n=-1):
+    def readinto(self, b):
         if not self._readable:
             raise PermissionError('File opened write-only')
-        r = super().read(n)
-        return r
+        n = min(len(b), self.bufsize, self._get_size() - self.pos)
+        if n <= 0:
+            return 0
+        data = self.rfs.read(self.pos, n)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def readall(self):
+        # RawIOBase.readall reads in small blocks, instead read the remainder
+        # of the file in bufsize chunks and join them once at the end
+        if not self._readable:
+            raise PermissionError('File opened write-only')
+        end = self._get_size()
+        chunks = []
+        while self.pos < end:
+            nread = min(self.bufsize, end - self.pos)
+            chunks.append(self.rfs.read(self.pos, nread))
+            self.pos += nread
+        return b''.join(chunks)
 
     def readable(self):
         return self._readable
 
-    # io.IOBase methods
-    # TODO: Make more efficient?
-
-    def readline(self, size=-1):
-        line = b''
-        while self.pos < self.rfs.size() and (size < 0 or len(line) < size):
-            buf = self.read(self.bufsize)
-            eol = buf.find(b'\n')
-            if eol < 0:
-                line += buf
-            else:
-                line += buf[:eol + 1]
-                self.pos -= (len(buf) - eol - 1)
-                break
-        return line
-
-    def readlines(self, hint=-1):
-        lines = []
-        c = 0
-        while self.pos < self.rfs.size() and (hint < 0 or c < hint):
-            line = self.readline(hint)
-            lines.append(line)
-            c += len(line)
-        return lines
-
     def seekable(self):
         return True
 
@@ -106,7 +277,8 @@ class OriginalFileObj(omero.gateway._OriginalFileAsFileObj, IOBase):
             raise PermissionError('File opened read-only')
         if size is None:
             size = self.pos
-        currentsize = self.rfs.size()
+        # Truncating to 0 never extends the file so the size isn't needed
+        currentsize = self._get_size() if size else 0
         currentpos = self.pos
         if size > currentsize:
             self.pos = currentsize
@@ -114,43 +286,44 @@ class OriginalFileObj(omero.gateway._OriginalFileAsFileObj, IOBase):
             self.pos = currentpos
         else:
             self.rfs.truncate(size)
+            self._size = size
         return size
 
     def write(self, buf):
         if not self._writable:
             raise PermissionError('File opened read-only')
-        n = len(buf)
-        self.rfs.write(buf, self.pos, n)
+        # Slicing a byte view doesn't copy, and nbytes is the correct length
+        # for any buffer, not just bytes
+        view = memoryview(buf).cast('B')
+        n = view.nbytes
+        for offset in range(0, n, WRITE_CHUNK_SIZE):
+            chunk = view[offset:offset + WRITE_CHUNK_SIZE]
+            self.rfs.write(chunk, self.pos + offset, len(chunk))
         self.pos += n
-        return len(buf)
+        if self._size is not None:
+            self._size = max(self._size, self.pos)
+        return n
 
     def writable(self):
         return self._writable
 
-    def writelines(self, lines):
-        for line in lines:
-            self.write(line)
-
-    def __iter__(self):
-        while self.pos < self.rfs.size():
-            yield self.readline()
 
-    def __next__(self):
-        if self.pos < self.rfs.size():
-            return self.readline()
-        raise StopIteration
+def _buffered(raw, buffer_size=BUFFER_SIZE):
+    # Wrap an OriginalFileObj in the buffered stream matching its mode
+    if raw.readable() and raw.writable():
+        return BufferedRandom(raw, buffer_size)
+    if raw.readable():
+        return BufferedReader(raw, buffer_size)
+    return BufferedWriter(raw, buffer_size)
 
 
 class CachedResource:
 
-    def __init__(self, path, resource):
-        if isinstance(resource, TagAnnotationWrapper):
-            self.type = ResourceType.directory
-        elif isinstance(resource, OriginalFileWrapper):
-            self.type = ResourceType.file
-        else:
-            raise ValueError('Unexpected object: {}'.format(resource))
-        self.id = resource.id
+    __slots__ = ('type', 'id', 'path', 'time')
+
+    def __init__(self, path, type, id):
+        self.type = type
+        self.id = id
         self.path = path
         self.time = time()
 
@@ -159,102 +332,428 @@ class CachedResource:
             self.path, self.type.name, self.id, self.time)
 
 
+class PooledSession:
+
+    def __init__(self, key, client, conn):
+        self.key = key
+        self.client = client
+        self.conn = conn
+        self.refcount = 0
+        self.time = time()
+
+    def __str__(self):
+        return 'PooledSession({}@{} refcount={} {:.0f})'.format(
+            self.key[1], self.key[0], self.refcount, self.time)
+
+
+# Process-wide sessions shared by OmeroFS instances with the same connection
+# parameters
+_SESSION_POOL = {}
+_SESSION_POOL_LOCK = Lock()
+# Background timer that closes sessions once they've been idle for
+# SESSION_POOL_TTL, otherwise they'd only be closed by the next acquire or
+# release
+_SESSION_POOL_TIMER = None
+# Passwords in pool keys are replaced by a keyed hash so they aren't kept
+_SESSION_POOL_SALT = os.urandom(16)
+
+
+def _session_key(host, user, passwd, groupid, keepalive):
+    # The password is part of the key so that a session is only shared with
+    # a caller who could have created it
+    digest = hmac.new(
+        _SESSION_POOL_SALT, passwd.encode(), hashlib.sha256).digest()
+    return (host, user, digest, groupid, keepalive)
+
+
+def _acquire_session(host, user, passwd, groupid, keepalive):
+    key = _session_key(host, user, passwd, groupid, keepalive)
+    # Server calls are made without holding the lock so that a slow login
+    # doesn't block other filesystems
+    with _SESSION_POOL_LOCK:
+        expired = _evict_sessions()
+        pooled = _SESSION_POOL.get(key)
+        if pooled:
+            pooled.refcount += 1
+            idle = pooled.refcount == 1
+    _close_sessions(expired)
+    if pooled:
+        # An idle session may have been closed by the server
+        if not idle or _is_alive(pooled.conn):
+            return pooled
+        # Other filesystems may have been given the session while it was
+        # checked, but it mustn't be handed out again
+        with _SESSION_POOL_LOCK:
+            pooled.refcount -= 1
+            if _SESSION_POOL.get(key) is pooled:
+                del _SESSION_POOL[key]
+        _close_conn(pooled.conn)
+
+    # Use omero.client to get a better error message if connect fails
+    client = omero.client(host)
+    try:
+        client.setAgent('fs-omero-pyfs')
+        session = client.createSession(user, passwd)
+        assert session
+        # Ping the server so the session isn't closed when idle
+        if keepalive > 0:
+            client.enableKeepAlive(keepalive)
+        conn = BlitzGateway(client_obj=client)
+        conn.SERVICE_OPTS.setOmeroGroup(groupid)
+    except Exception:
+        try:
+            client.closeSession()
+        except Exception:
+            pass
+        raise
+    pooled = PooledSession(key, client, conn)
+    with _SESSION_POOL_LOCK:
+        existing = _SESSION_POOL.get(key)
+        if existing:
+            # Another thread connected first, use its session instead
+            existing.refcount += 1
+        else:
+            _SESSION_POOL[key] = pooled
+            pooled.refcount += 1
+    if existing:
+        _close_conn(conn)
+        return existing
+    return pooled
+
+
+def _release_session(pooled):
+    with _SESSION_POOL_LOCK:
+        pooled.refcount -= 1
+        pooled.time = time()
+        expired = _evict_sessions()
+        _schedule_eviction()
+    _close_sessions(expired)
+
+
+def _schedule_eviction():
+    # Must be called with _SESSION_POOL_LOCK held
+    global _SESSION_POOL_TIMER
+    if _SESSION_POOL_TIMER or SESSION_POOL_TTL <= 0:
+        return
+    idle = [p.time for p in _SESSION_POOL.values() if not p.refcount]
+    if idle:
+        delay = max(min(idle) + SESSION_POOL_TTL - time(), 0)
+        _SESSION_POOL_TIMER = Timer(delay, _evict_idle_sessions)
+        _SESSION_POOL_TIMER.daemon = True
+        _SESSION_POOL_TIMER.start()
+
+
+def _evict_idle_sessions():
+    global _SESSION_POOL_TIMER
+    with _SESSION_POOL_LOCK:
+        _SESSION_POOL_TIMER = None
+        expired = _evict_sessions()
+        _schedule_eviction()
+    _close_sessions(expired)
+
+
+def _evict_sessions(ttl=None):
+    # Must be called with _SESSION_POOL_LOCK held. Removes expired sessions
+    # from the pool and returns them, they should be closed after the lock
+    # is released.
+    if ttl is None:
+        ttl = SESSION_POOL_TTL
+    now = time()
+    expired = []
+    for key, pooled in list(_SESSION_POOL.items()):
+        if not pooled.refcount and pooled.time + ttl <= now:
+            del _SESSION_POOL[key]
+            expired.append(pooled)
+    return expired
+
+
+def _close_sessions(sessions):
+    for pooled in sessions:
+        _close_conn(pooled.conn)
+
+
+def _is_alive(conn):
+    try:
+        return conn.keepAlive()
+    except Exception:
+        return False
+
+
+def _close_conn(conn):
+    try:
+        conn.close()
+    except Exception as e:
+        logging.getLogger(__name__).warning(
+            'Failed to close session: %s', e)
+
+
+@atexit.register
+def _close_all_sessions():
+    with _SESSION_POOL_LOCK:
+        if _SESSION_POOL_TIMER:
+            _SESSION_POOL_TIMER.cancel()
+        expired = _evict_sessions(ttl=0)
+    _close_sessions(expired)
+
+
+class _WalkListing:
+    # Directory listings for a single OmeroWalker walk. Scanning a directory
+    # that hasn't been listed also lists the other directories found so far
+    # that the walk will scan, up to QUERY_BATCH_SIZE per query.
+
+    def __init__(self, walker, fs, path):
+        self.walker = walker
+        self.fs = fs
+        self.depth = walker._calculate_depth(path)
+        # Directory path: id of directories to be listed
+        self.pending = OrderedDict()
+        # Directory path: list of Info of directories listed but not scanned
+        self.listing = {}
+
+    def scan(self, dir_path):
+        if dir_path not in self.listing:
+            self._fetch(dir_path)
+        return self.listing.pop(dir_path)
+
+    def _fetch(self, dir_path):
+        walker = self.walker
+        id = self.pending.pop(dir_path, None)
+        if id is None:
+            # Raises the same errors as scandir
+            id = self.fs._get_dir(dir_path).id
+        dirs = {id: dir_path}
+        # A depth first walk scans the most recently found directories first
+        last = walker.search == 'depth'
+        while self.pending and len(dirs) < QUERY_BATCH_SIZE:
+            path, id = self.pending.popitem(last=last)
+            if id in dirs:
+                # Linked from more than one parent, list this path later
+                self.pending[path] = id
+                break
+            dirs[id] = path
+        for path, children in self.fs._list_dirs(dirs).items():
+            self.listing[path] = [info for info, _ in children]
+            # The same checks as the walk so excluded directories and any
+            # below max_depth aren't listed
+            depth = walker._calculate_depth(path) - self.depth + 1
+            for info, id in children:
+                if (info.is_dir and
+                        walker._check_open_dir(self.fs, path, info) and
+                        walker._check_scan_dir(self.fs, path, info, depth)):
+                    self.pending[combine(path, info.name)] = id
+
+
+class OmeroWalker(Walker):
+    """
+    Walker that lists several directories with each query instead of running
+    scandir on every directory.
+    """
+
+    _listing = None
+
+    def _iter_walk(self, fs, path, namespaces=None):
+        if not isinstance(fs, OmeroFS):
+            return super()._iter_walk(fs, path, namespaces=namespaces)
+        # Use a copy so that each walk has its own listing, walks using the
+        # same walker may be nested or interleaved
+        walker = copy(self)
+        walker._listing = _WalkListing(walker, fs, path)
+        return super(OmeroWalker, walker)._iter_walk(
+            fs, path, namespaces=namespaces)
+
+    def _scan(self, fs, dir_path, namespaces=None):
+        if self._listing is None:
+            return super()._scan(fs, dir_path, namespaces=namespaces)
+        return self._scan_listing(dir_path)
+
+    def _scan_listing(self, dir_path):
+        try:
+            infos = self._listing.scan(dir_path)
+        except FSError as error:
+            if not self.on_error(dir_path, error):
+                raise
+            infos = []
+        for info in infos:
+            yield info
+
+
 class OmeroFS(FS):
 
     # https://github.com/PyFilesystem/pyfilesystem2/blob/129567606066cd002bb45a11aae543f7b73f0134/fs/base.py#L675
     _meta = {
         'case_insensitive': False,
-        'invalid_path_chars': '\0',
+        'invalid_path_chars': INVALID_PATH_CHARS,
         'max_path_length': None,
         'max_sys_path_length': None,
         'network': True,
         'read_only': False,
         'supports_rename': True,
+        'thread_safe': True,
     }
 
-    def __init__(self, *, host, user, passwd, root='/', create=True,
-                 ns=DEFAULT_NS, groupid=None, cache_ttl=2):
+    walker_class = OmeroWalker
+
+    def __init__(self, *, host=None, user=None, passwd=None, root='/',
+                 create=True, ns=DEFAULT_NS, groupid=None, cache_ttl=2,
+                 cache_size=DEFAULT_CACHE_SIZE, keepalive=60, conn=None):
+        """
+        Either host, user and passwd, or conn, an existing BlitzGateway, must
+        be given. conn is used as is and isn't closed by close(), so groupid
+        and keepalive are ignored.
+        Paths are cached for cache_ttl seconds without checking the server,
+        so changes made by other clients may not be seen until they expire.
+        """
         super().__init__()
+        # Set first since close() is called if __init__ fails
+        self._session = None
+        if conn is None and None in (host, user, passwd):
+            raise ValueError('host, user and passwd or conn are required')
         self.log = logging.getLogger(__name__)
         self.strlabel = '{}: {}@{} ns={} groupid={} cache_ttl={}'.format(
             __name__, user, host, ns, groupid, cache_ttl)
         self.ns = ns
+        self._ns_param = rstring(ns)
 
-        # Use omero.client to get a better error message if connect fails
         try:
-            client = omero.client(host)
-            client.setAgent('fs-omero-pyfs')
-            session = client.createSession(user, passwd)
-            assert session
-            self.conn = BlitzGateway(client_obj=client)
-            self.conn.SERVICE_OPTS.setOmeroGroup(groupid)
+            if conn is None:
+                self._session = _acquire_session(
+                    host, user, passwd, groupid, keepalive)
+                self.conn = self._session.conn
+            else:
+                self.conn = conn
+            # The gateway's service wrappers reconnect themselves if
+            # necessary so they only need to be looked up once
+            self._qs = self.conn.getQueryService()
+            self._us = self.conn.getUpdateService()
         except Exception as e:
+            if self._session:
+                _release_session(self._session)
+                self._session = None
             raise RemoteConnectionError(
                 exc=e, msg='Failed to connect: {}'.format(self))
-        self.path_cache = {}
+        # Separate from self._lock which FS holds for whole operations
+        self._cache_lock = Lock()
+        self.path_cache = OrderedDict()
+        self.missing_cache = OrderedDict()
         self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
         self.root = root
         self.log.debug('Connected: %s', self)
-        if not self._get_dir(root, throw=(not create)):
-            self._create_tag(root)
+        try:
+            if not self._get_dir(root, throw=(not create)):
+                self._cache_put_id(root, ResourceType.directory,
+                                   self._create_tag(root).id)
+        except Exception:
+            self.close()
+            raise
 
     def __str__(self):
         return self.strlabel
 
-    def _cache_put(self, path, resource):
-        # self.log.debug('_cache_put(%s)', path)
-        if self.cache_ttl > 0:
-            self.path_cache[path] = CachedResource(path, resource)
+    def _cache_put_id(self, path, type, id):
+        with self._cache_lock:
+            self.missing_cache.pop((ResourceType.directory, path), None)
+            self.missing_cache.pop((ResourceType.file, path), None)
+            if self.cache_ttl > 0:
+                self.path_cache[path] = CachedResource(path, type, id)
+                self.path_cache.move_to_end(path)
+                if len(self.path_cache) > self.cache_size:
+                    self.path_cache.popitem(last=False)
 
     def _cache_get(self, path):
         # self.log.debug('_cache_get(%s)', path)
         if self.cache_ttl <= 0:
             return None
-        try:
-            cached = self.path_cache[path]
-        except KeyError:
-            return None
-        if cached.time + self.cache_ttl > time():
-            # self.log.debug('%s', cached)
-            return cached
-        self._cache_remove(path)
+        with self._cache_lock:
+            try:
+                cached = self.path_cache[path]
+            except KeyError:
+                return None
+            if cached.time + self.cache_ttl > time():
+                # self.log.debug('%s', cached)
+                self.path_cache.move_to_end(path)
+                return cached
+            self.path_cache.pop(path, None)
         return None
 
     def _cache_remove(self, path):
         # self.log.debug('_cache_remove(%s)', path)
-        self.path_cache.pop(path, None)
+        with self._cache_lock:
+            self.path_cache.pop(path, None)
+
+    def _missing_put(self, path, type):
+        # Negative lookup cache, path is known not to be of this type
+        if self.cache_ttl > 0:
+            key = (type, path)
+            with self._cache_lock:
+                self.missing_cache[key] = time()
+                self.missing_cache.move_to_end(key)
+                if len(self.missing_cache) > self.cache_size:
+                    self.missing_cache.popitem(last=False)
+
+    def _missing_get(self, path, type):
+        if self.cache_ttl <= 0:
+            return False
+        key = (type, path)
+        with self._cache_lock:
+            try:
+                t = self.missing_cache[key]
+            except KeyError:
+                return False
+            if t + self.cache_ttl > time():
+                return True
+            self.missing_cache.pop(key, None)
+        return False
+
+    def _params(self, **kwargs):
+        # All queries are restricted to this filesystem's namespace, which is
+        # bound to an rstring once in __init__ and passed in the initial map.
+        # id and ids are added as ids, other arguments as strings.
+        params = omero.sys.ParametersI({'ns': self._ns_param})
+        for name, value in kwargs.items():
+            if name == 'id':
+                params.addId(value)
+            elif name == 'ids':
+                params.addIds(value)
+            else:
+                params.addString(name, value)
+        return params
+
+    def validatepath(self, path):
+        # This is called several times for every operation, so the
+        # normalised paths are cached
+        self.check()
+        return _validatepath(path)
 
     def _split_basename(self, path):
-        path = self.validatepath(path)
-        dirname, basename = path.rsplit('/', 1)
-        return self.validatepath(dirname), basename
+        # path is normalised so dirname doesn't need validating again, and
+        # rpartition doesn't build an intermediate list like rsplit
+        dirname, _, basename = self.validatepath(path).rpartition('/')
+        return dirname or '/', basename
 
     def _get_file(self, path, throw=True, checkother=True):
         self.log.debug('_get_file %s %s %s', path, throw, checkother)
         vpath = self.validatepath(path)
         cached = self._cache_get(vpath)
         if cached and cached.type == ResourceType.file:
-            return self.conn.getObject('OriginalFile', cached.id)
-        dirname, basename = self._split_basename(path)
-        if not basename:
-            if throw:
-                raise FileExpected(path)
-        parent = self._get_dir(dirname, throw=False, checkother=False)
-        if not parent:
-            if throw:
-                raise ResourceNotFound(path)
-            return None
-        params = omero.sys.ParametersI()
-        params.addId(parent.id)
-        params.addString('ns', self.ns)
-        params.addString('filename', basename)
-        files = unwrap(self.conn.getQueryService().projection(
-            'SELECT parent.id FROM OriginalFileAnnotationLink '
-            'WHERE parent.name=:filename '
-            'AND child.id=:id '
-            'AND child.ns=:ns '
-            'AND child.class=TagAnnotation',
-            params))
+            return FileRef(self.conn, cached.id)
+        if self._missing_get(vpath, ResourceType.file):
+            files = []
+        else:
+            dirname, basename = self._split_basename(path)
+            if not basename:
+                if throw:
+                    raise FileExpected(path)
+            parent = self._get_dir(dirname, throw=False, checkother=False)
+            if not parent:
+                self._missing_put(vpath, ResourceType.file)
+                if throw:
+                    raise ResourceNotFound(path)
+                return None
+            params = self._params(id=parent.id, filename=basename)
+            files = unwrap(self._qs.projection(_Q_GET_FILE_ID, params))
+            if not files:
+                self._missing_put(vpath, ResourceType.file)
         if not files:
             if throw:
                 if checkother and self._get_dir(path, throw=False):
@@ -265,14 +764,14 @@ class OmeroFS(FS):
             raise ResourceError(
                 path, msg='Multiple files [{}] found with same path'.format(
                     len(files)))
-        file = self.conn.getObject('OriginalFile', files[0][0])
-        self._cache_put(vpath, file)
+        file = FileRef(self.conn, files[0][0])
+        self._cache_put_id(vpath, ResourceType.file, file.id)
         return file
 
     def _get_dir_ignore_parents(self, path, throw=True, checkother=True):
         vpath = self.validatepath(path)
-        dirs = list(self.conn.getObjects('TagAnnotation',
-                    attributes={'ns': self.ns, 'textValue': vpath}))
+        params = self._params(path=vpath)
+        dirs = unwrap(self._qs.projection(_Q_GET_ROOT_ID, params))
         if not dirs:
             if throw:
                 if checkother and self._get_file(
@@ -284,14 +783,14 @@ class OmeroFS(FS):
             raise ResourceError(
                 path, msg='Multiple directories [{}] found with same path'
                 .format(len(dirs)))
-        return dirs[0]
+        return TagRef(dirs[0][0])
 
     def _get_dir(self, path, throw=True, checkother=True):
         self.log.debug('_get_dir %s %s %s', path, throw, checkother)
         vpath = self.validatepath(path)
         cached = self._cache_get(vpath)
         if cached and cached.type == ResourceType.directory:
-            return self.conn.getObject('TagAnnotation', cached.id)
+            return TagRef(cached.id)
         dirname, basename = self._split_basename(path)
         if not basename:
             if dirname != self.root:
@@ -301,25 +800,22 @@ class OmeroFS(FS):
             dir = self._get_dir_ignore_parents(
                 dirname, throw=throw, checkother=checkother)
             if dir:
-                self._cache_put(vpath, dir)
+                self._cache_put_id(vpath, ResourceType.directory, dir.id)
             return dir
 
-        parent = self._get_dir(dirname, throw=False, checkother=False)
-        if not parent:
-            if throw:
-                raise ResourceNotFound(path)
-            return None
-        params = omero.sys.ParametersI()
-        params.addString('basename', basename)
-        params.addString('ns', self.ns)
-        params.addId(parent.id)
-        dirs = unwrap(self.conn.getQueryService().projection(
-            'SELECT child.id FROM AnnotationAnnotationLink '
-            'WHERE parent.id=:id '
-            'AND child.textValue=:basename '
-            'AND child.ns=:ns '
-            'AND child.class=TagAnnotation',
-            params))
+        if self._missing_get(vpath, ResourceType.directory):
+            dirs = []
+        else:
+            parent = self._get_dir(dirname, throw=False, checkother=False)
+            if not parent:
+                self._missing_put(vpath, ResourceType.directory)
+                if throw:
+                    raise ResourceNotFound(path)
+                return None
+            params = self._params(id=parent.id, basename=basename)
+            dirs = unwrap(self._qs.projection(_Q_GET_DIR_ID, params))
+            if not dirs:
+                self._missing_put(vpath, ResourceType.directory)
         if not dirs:
             if throw:
                 if checkother and self._get_file(path, throw=False):
@@ -330,81 +826,260 @@ class OmeroFS(FS):
             raise ResourceError(
                 path, msg='Multiple directories [{}] found with same path'
                 .format(len(dirs)))
-        dir = self.conn.getObject('TagAnnotation', dirs[0][0])
-        self._cache_put(vpath, dir)
+        dir = TagRef(dirs[0][0])
+        self._cache_put_id(vpath, ResourceType.directory, dir.id)
         return dir
 
     def _create_tag(self, path, parent=None):
         # path assumed to be validated
-        d = omero.gateway.TagAnnotationWrapper(
-            self.conn, omero.model.TagAnnotationI())
-        d.setNs(self.ns)
-        d.setTextValue(path, wrap=True)
-        d.save()
-        # OMERO_CLASS is None which causes linkAnnotation to fail
+        tag = omero.model.TagAnnotationI()
+        tag.setNs(self._ns_param)
+        tag.setTextValue(rstring(path))
+        update = self._us
         if parent:
-            parent.OMERO_CLASS = 'Annotation'
-            parent.linkAnnotation(d)
-        return d
+            # Saving the link also saves the new tag, so only one call
+            link = omero.model.AnnotationAnnotationLinkI()
+            link.setParent(omero.model.TagAnnotationI(parent.id, False))
+            link.setChild(tag)
+            link = update.saveAndReturnObject(link, self.conn.SERVICE_OPTS)
+            tag = link.getChild()
+        else:
+            tag = update.saveAndReturnObject(tag, self.conn.SERVICE_OPTS)
+        return TagRef(tag.getId().getValue())
 
-    def getinfo(self, path, namespaces=None):
+    def _create_file(self, dirname, basename, parent):
+        # Saving the link also saves the new file, so only one call
+        # The size and mtime are only set by the server when the file's
+        # content is written, so set them here in case it never is
+        f = omero.model.OriginalFileI()
+        f.setName(rstring(basename))
+        f.setPath(rstring(dirname))
+        f.setSize(rlong(0))
+        f.setMtime(rtime(int(time() * 1000)))
+        link = omero.model.OriginalFileAnnotationLinkI()
+        link.setParent(f)
+        link.setChild(omero.model.TagAnnotationI(parent.id, False))
+        link = self._us.saveAndReturnObject(link, self.conn.SERVICE_OPTS)
+        return link.getParent().getId().getValue()
+
+    def _resolve_path(self, path, checkmissing=True):
         """
-        Get info regarding a file or directory.
+        Look up a path of unknown type using projections only.
+        Returns a list of rows, either ('D', id, created) for a directory or
+        ('F', id, ctime, mtime, size, created) for a file.
+        HQL has no UNION so this is one query per type, but the second query
+        is skipped if the first matches, and no wrappers are loaded.
+        If checkmissing is False the negative cache is ignored.
         """
         vpath = self.validatepath(path)
         dirname, basename = self._split_basename(path)
-        d = {'basic': {'name': basename}, 'details': {}}
+        if not basename:
+            params = self._params(path=vpath)
+            return [['D'] + r for r in unwrap(self._qs.projection(
+                _Q_RESOLVE_ROOT, params))]
 
+        parent = self._get_dir(dirname, throw=False, checkother=False)
+        if not parent:
+            return []
+        params = self._params(id=parent.id, basename=basename)
+        # A path can't be both a file and a directory, so stop at the first
+        # match. The cached type is checked first, otherwise files since
+        # they're usually more common.
         cached = self._cache_get(vpath)
-        dir = None
-        file = None
         if cached and cached.type == ResourceType.directory:
-            dir = self._get_dir(path, throw=False, checkother=False)
-        elif cached and cached.type == ResourceType.file:
-            file = self._get_file(path, throw=False, checkother=False)
+            kinds = ('D', 'F')
         else:
-            dir = self._get_dir(path, throw=False, checkother=False)
-            file = self._get_file(path, throw=False, checkother=False)
-        if dir and file:
-            raise ResourceError(
-                path, msg='Directory and file found with same path')
-        if not dir and not file:
+            kinds = ('F', 'D')
+        stale = False
+        for kind in kinds:
+            if kind == 'D':
+                type, query = ResourceType.directory, _Q_RESOLVE_DIR
+            else:
+                type, query = ResourceType.file, _Q_RESOLVE_FILE
+            if (checkmissing and not stale and
+                    self._missing_get(vpath, type)):
+                continue
+            rows = [[kind] + r for r in unwrap(self._qs.projection(
+                query, params))]
+            if rows:
+                return rows
+            if cached and cached.type == type:
+                # Removed or replaced by another client, so the other type
+                # must be checked even if it's in the negative cache
+                self._cache_remove(vpath)
+                stale = True
+            self._missing_put(vpath, type)
+        return []
+
+    def getinfo(self, path, namespaces=None):
+        """
+        Get info regarding a file or directory.
+        """
+        vpath = self.validatepath(path)
+        dirname, basename = self._split_basename(path)
+        rows = self._resolve_path(path)
+        if not rows:
             raise ResourceNotFound(path)
+        if len(rows) > 1:
+            raise ResourceError(
+                path, msg='Multiple resources [{}] found with same path'
+                .format(len(rows)))
 
-        if dir:
-            d['basic']['is_dir'] = True
-            d['details']['created'] = (
-                dir.details.creationEvent.time.val / 1000)
-            d['details']['size'] = 0
-            d['details']['type'] = ResourceType.directory
+        row = rows[0]
+        if row[0] == 'D':
+            self._cache_put_id(vpath, ResourceType.directory, row[1])
         else:
-            d['basic']['is_dir'] = False
-            d['details']['created'] = (
-                file.ctime or file.details.creationEvent.time.val) / 1000
-            d['details']['modified'] = file.mtime / 1000
-            d['details']['size'] = file.size
-            d['details']['type'] = ResourceType.file
-        return Info(d)
+            self._cache_put_id(vpath, ResourceType.file, row[1])
+        return self._make_info(basename, row)
 
-    def listdir(self, path):
+    def _get_type(self, path):
+        # Use the cache if possible since the Info metadata isn't needed
+        vpath = self.validatepath(path)
+        cached = self._cache_get(vpath)
+        if cached:
+            return cached.type
+        rows = self._resolve_path(path)
+        if not rows:
+            return None
+        if rows[0][0] == 'D':
+            type = ResourceType.directory
+        else:
+            type = ResourceType.file
+        self._cache_put_id(vpath, type, rows[0][1])
+        return type
+
+    def exists(self, path):
         """
-        Get a list of resources in a directory.
+        Check if a path maps to a resource.
+        """
+        return self._get_type(path) is not None
+
+    def isdir(self, path):
+        """
+        Check if a path maps to an existing directory.
+        """
+        return self._get_type(path) == ResourceType.directory
+
+    def isfile(self, path):
+        """
+        Check if a path maps to an existing file.
+        """
+        return self._get_type(path) == ResourceType.file
+
+    def _make_info(self, name, row):
+        # row is in the format returned by _resolve_path
+        if row[0] == 'D':
+            return Info({
+                'basic': {'name': name, 'is_dir': True},
+                'details': {
+                    'created': row[2] / 1000,
+                    'size': 0,
+                    'type': ResourceType.directory,
+                },
+            })
+        _, id, ctime, mtime, size, created = row
+        # Files created by other clients may not have an mtime or size
+        return Info({
+            'basic': {'name': name, 'is_dir': False},
+            'details': {
+                'created': (ctime or created) / 1000,
+                'modified': None if mtime is None else mtime / 1000,
+                'size': size or 0,
+                'type': ResourceType.file,
+            },
+        })
+
+    def _iter_children(self, path, page_size=500, info=True):
+        """
+        Iterate through the children of a directory, fetching page_size
+        results per query. Yields (name, row) where row is in the format
+        returned by _resolve_path if info is True, otherwise (kind, id).
+        The directory is checked immediately, not on the first iteration.
         """
         parent = self._get_dir(path)
-        params = omero.sys.ParametersI()
-        params.addId(parent.id)
-        params.addString('ns', self.ns)
+        vpath = self.validatepath(path)
+        return self._iter_children_rows(parent, vpath, page_size, info)
 
-        rdirs = unwrap(self.conn.getQueryService().projection(
-            'SELECT child.id, child.textValue FROM AnnotationAnnotationLink '
-            'WHERE parent.id=:id AND child.ns=:ns',
-            params))
+    def _iter_children_rows(self, parent, vpath, page_size, info):
+        params = self._params(id=parent.id)
+        if info:
+            queries = (('D', _Q_LIST_DIRS_INFO), ('F', _Q_LIST_FILES_INFO))
+        else:
+            queries = (('D', _Q_LIST_DIRS), ('F', _Q_LIST_FILES))
+        # Page on the id instead of an offset so that removing children
+        # while iterating, as removetree does, doesn't skip any
+        params.page(0, page_size)
+        for kind, query in queries:
+            last = 0
+            while True:
+                params.add('last', rlong(last))
+                rows = unwrap(self._qs.projection(query, params))
+                for r in rows:
+                    name = r[-1]
+                    if kind == 'D':
+                        name = self._split_basename(name)[1]
+                        type = ResourceType.directory
+                    else:
+                        type = ResourceType.file
+                    # Cache the children so that a following getinfo or
+                    # open doesn't have to look them up again
+                    self._cache_put_id(join(vpath, name), type, r[0])
+                    yield name, [kind] + r[:-1]
+                if len(rows) < page_size:
+                    break
+                last = rows[-1][0]
+
+    def _list_dirs(self, dirs, page_size=500):
+        """
+        List the children of several directories with one paged query for
+        directories and one for files. dirs is a dict of directory id: path.
+        Returns a dict of path: list of (Info, id), directories first.
+        The path cache isn't updated since a walk can list far more paths
+        than it holds.
+        """
+        listing = {path: [] for path in dirs.values()}
+        params = self._params(ids=list(dirs))
+        for kind, query in (('D', _Q_WALK_DIRS), ('F', _Q_WALK_FILES)):
+            offset = 0
+            while True:
+                params.page(offset, page_size)
+                rows = unwrap(self._qs.projection(query, params))
+                for r in rows:
+                    name = r[-1]
+                    if kind == 'D':
+                        name = self._split_basename(name)[1]
+                    info = self._make_info(name, [kind] + r[1:-1])
+                    listing[dirs[r[0]]].append((info, r[1]))
+                if len(rows) < page_size:
+                    break
+                offset += page_size
+        return listing
+
+    @property
+    def walk(self):
+        """
+        A walker bound to this filesystem using walker_class.
+        FS.walk calls Walker.bind which always uses the default Walker.
+        """
+        return BoundWalker(self, self.walker_class)
+
+    def listdir(self, path):
+        """
+        Get a list of resources in a directory.
+        """
+        return [name for name, _ in self._iter_children(path, info=False)]
 
-        filelinks = list(self.conn.getAnnotationLinks(
-            'OriginalFile', ann_ids=[parent.id]))
-        # For files the file is the parent in the link
-        return ([self._split_basename(d[1])[1] for d in rdirs] +
-                [f.parent.name.val for f in filelinks])
+    def scandir(self, path, namespaces=None, page=None):
+        """
+        Get an iterator of resource info.
+        Info is built from the directory listing without a query per child.
+        """
+        infos = (self._make_info(name, row)
+                 for name, row in self._iter_children(path))
+        if page is not None:
+            start, end = page
+            infos = islice(infos, start, end)
+        return infos
 
     def makedir(self, path, permissions=None, recreate=False):
         """
@@ -417,16 +1092,57 @@ class OmeroFS(FS):
             raise DirectoryExists(path)
         vpath = self.validatepath(path)
         dirname, basename = self._split_basename(path)
-        d = self._get_dir(path, throw=False)
-        if d:
-            if not recreate:
-                raise DirectoryExists(path)
-        else:
-            parent = self._get_dir(dirname)
-            d = self._create_tag(basename, parent)
-            self._cache_put(vpath, d)
+        # Hold the lock so that threads can't both create the directory
+        with self._lock:
+            d = self._get_dir(path, throw=False)
+            if d:
+                if not recreate:
+                    raise DirectoryExists(path)
+            else:
+                # A missing parent is ResourceNotFound even if it's a file,
+                # so don't look for a file
+                parent = self._get_dir(dirname, checkother=False)
+                d = self._create_tag(basename, parent)
+                self._cache_put_id(vpath, ResourceType.directory, d.id)
         return SubFS(self, vpath)
 
+    def _find_file_id(self, path, checkmissing=True):
+        # Look up a file id on the server, None if not found
+        rows = self._resolve_path(path, checkmissing)
+        if len(rows) > 1:
+            raise ResourceError(
+                path, msg='Multiple files [{}] found with same path'
+                .format(len(rows)))
+        if rows and rows[0][0] == 'D':
+            raise FileExpected(path)
+        if rows:
+            return rows[0][1]
+        return None
+
+    def _open_file(self, fileid, mode, bufsize, buffer_size, size=None):
+        # Open a file on the server and position it for mode. An existing
+        # file is accessed before returning so that a file which no longer
+        # exists fails here with omero.ServerError.
+        fobj = OriginalFileObj(
+            FileRef(self.conn, fileid),
+            readable=('r' in mode or '+' in mode),
+            writable=('r' not in mode or '+' in mode),
+            bufsize=bufsize, size=size)
+        try:
+            # A new file is empty so the position is already at the end,
+            # only an existing file needs to be truncated or positioned
+            if size is None:
+                if 'w' in mode:
+                    fobj.truncate(0)
+                elif 'a' in mode:
+                    fobj.seek(0, Seek.end)
+                else:
+                    fobj._get_size()
+        except Exception:
+            fobj.close()
+            raise
+        return _buffered(fobj, buffer_size)
+
     def openbin(self, path, mode='r', buffering=-1, **options):
         """
         Open a binary file.
@@ -434,33 +1150,60 @@ class OmeroFS(FS):
         if 't' in mode:
             raise ValueError('Text mode not supported')
         mode = mode.replace('b', '')
+        vpath = self.validatepath(path)
         dirname, basename = self._split_basename(path)
         parent = self._get_dir(dirname, throw=False)
-        if self._get_dir(path, throw=False):
-            raise FileExpected(path)
-
         if not parent:
             raise ResourceNotFound(path, 'Parent directory not found')
+
+        # buffering sets both the buffer size of the returned stream and the
+        # OMERO read-block size, it's raised to OriginalFileObj.MIN_BUFSIZE
+        if buffering > 1:
+            bufsize = buffer_size = max(
+                buffering, OriginalFileObj.MIN_BUFSIZE)
+        else:
+            bufsize = OriginalFileObj.DEFAULT_BUFSIZE
+            buffer_size = BUFFER_SIZE
+
+        # Only the file id is needed, so if the path is cached there's no
+        # need to query the server
+        cached = self._cache_get(vpath)
+        if cached and cached.type == ResourceType.directory:
+            raise FileExpected(path)
+        if cached and 'x' not in mode:
+            try:
+                return self._open_file(
+                    cached.id, mode, bufsize, buffer_size)
+            except omero.ServerError as e:
+                # The file may have been deleted by another client
+                self.log.debug('Cached file %s failed: %s', path, e)
+                self._cache_remove(vpath)
+        fileid = self._find_file_id(path)
+
         if 'r' in mode:
-            f = self._get_file(path)
-            fobj = OriginalFileObj(f, writable=('+' in mode))
-            return fobj
+            if not fileid:
+                raise ResourceNotFound(path)
+            return self._open_file(fileid, mode, bufsize, buffer_size)
         if 'a' in mode or 'w' in mode or 'x' in mode:
-            f = self._get_file(path, throw=False)
-            if f and 'x' in mode:
+            if fileid and 'x' in mode:
                 raise FileExists(path)
-            if not f:
-                f = omero.gateway.OriginalFileWrapper(
-                    self.conn, omero.model.OriginalFileI())
-                f.setName(basename)
-                f.setPath(dirname, wrap=True)
-                f.save()
-                f.linkAnnotation(parent)
-            fobj = OriginalFileObj(f, readable=('+' in mode))
-            if 'w' in mode:
-                fobj.truncate(0)
-            fobj.seek(0, Seek.end)
-            return fobj
+            created = False
+            if not fileid:
+                # Check again while holding the lock so that threads opening
+                # the same new file don't both create it. The negative cache
+                # is ignored in case another client has created it since.
+                with self._lock:
+                    fileid = self._find_file_id(path, checkmissing=False)
+                    if fileid and 'x' in mode:
+                        raise FileExists(path)
+                    if not fileid:
+                        fileid = self._create_file(dirname, basename, parent)
+                        self._cache_put_id(
+                            vpath, ResourceType.file, fileid)
+                        created = True
+            return self._open_file(
+                fileid, mode, bufsize, buffer_size,
+                size=(0 if created else None))
         raise ValueError(
             'openbin mode "{}" not supported: {}'.format(mode, path))
 
@@ -471,7 +1214,7 @@ class OmeroFS(FS):
         vpath = self.validatepath(path)
         f = self._get_file(path)
         self._cache_remove(vpath)
-        self.conn.deleteObject(f._obj)
+        self.conn.deleteObject(omero.model.OriginalFileI(f.id, False))
 
     def removedir(self, path):
         """
@@ -486,11 +1229,11 @@ class OmeroFS(FS):
         if vpath == self.root:
             raise RemoveRootError(self.root)
         d = self._get_dir(path)
-        children = self.listdir(path)
-        if children:
+        # Only the first child is needed to know the directory isn't empty
+        if next(self._iter_children(path, page_size=1, info=False), None):
             raise DirectoryNotEmpty(path)
         self._cache_remove(vpath)
-        self.conn.deleteObject(d._obj)
+        self.conn.deleteObject(omero.model.TagAnnotationI(d.id, False))
 
     def setinfo(self, path, info):
         """
@@ -499,7 +1242,7 @@ class OmeroFS(FS):
         """
         mtime = info.get('details', {}).get('modified')
         ctime = info.get('details', {}).get('created')
-        f = self._get_file(path)
+        f = self.conn.getObject('OriginalFile', self._get_file(path).id)
         if mtime:
             f._obj.mtime = rtime(mtime * 1000)
         if ctime:
@@ -507,5 +1250,7 @@ class OmeroFS(FS):
         f.save()
 
     def close(self):
-        self.conn.close()
+        if not self.isclosed():
+            if self._session:
+                _release_session(self._session)
         super().close()
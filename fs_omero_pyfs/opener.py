@@ -36,5 +36,11 @@ class OmeroFSOpener(Opener):
         cache_ttl = parse_result.params.get('cache_ttl')
         if cache_ttl:
             omeroargs['cache_ttl'] = int(cache_ttl)
+        cache_size = parse_result.params.get('cache_size')
+        if cache_size:
+            omeroargs['cache_size'] = int(cache_size)
+        keepalive = parse_result.params.get('keepalive')
+        if keepalive:
+            omeroargs['keepalive'] = int(keepalive)
         omerofs = OmeroFS(**omeroargs)
         return omerofs
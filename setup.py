@@ -1,5 +1,8 @@
 import setuptools
 
+with open('README.md') as f:
+    long_description = f.read()
+
 setuptools.setup(
     name='fs-omero-pyfs',
     version='0.0.5',
@@ -7,7 +10,7 @@ setuptools.setup(
     author='Simon Li',
     license='MIT',
     description='OMERO PyFilesystem2 filesystem',
-    long_description=open('README.md').read(),
+    long_description=long_description,
     long_description_content_type='text/markdown',
     packages=setuptools.find_packages(),
     install_requires=[
@@ -1,17 +1,332 @@
 # https://docs.pyfilesystem.org/en/latest/implementers.html#testing-filesystems
+from concurrent.futures import ThreadPoolExecutor
+from fs import errors, ResourceType
+from fs.memoryfs import MemoryFS
 from fs.test import FSTestCases
 from fs_omero_pyfs import OmeroFS
-# import pytest
+import fs_omero_pyfs.fs as fsmod
+from fs_omero_pyfs.fs import (
+    FileRef,
+    OmeroWalker,
+    OriginalFileObj,
+)
+import omero.clients
+from omero.gateway import BlitzGateway
+import pytest
+from time import sleep
 import unittest
+from unittest import mock
 from uuid import uuid4
 
 
+@pytest.fixture(scope='session')
+def omero_conn():
+    # One session for all tests, each test is isolated by its namespace
+    client = omero.client('localhost')
+    client.createSession('root', 'omero')
+    conn = BlitzGateway(client_obj=client)
+    yield conn
+    conn.close()
+
+
 # Tests are inherited from
 # https://github.com/PyFilesystem/pyfilesystem2/blob/v2.4.11/fs/test.py#L248
 class TestOmeroFS(FSTestCases, unittest.TestCase):
 
+    @pytest.fixture(autouse=True)
+    def _omero_conn(self, omero_conn):
+        self.conn = omero_conn
+
     def make_fs(self):
         # Return an instance of your FS object here
-        return OmeroFS(
-            host='localhost', user='root', passwd='omero',
-            ns=str(uuid4()))
+        return OmeroFS(conn=self.conn, ns=str(uuid4()))
+
+    def test_missing_cache_invalidated(self):
+        self.assertFalse(self.fs.exists('newdir'))
+        self.assertTrue(
+            self.fs._missing_get('/newdir', ResourceType.directory))
+        self.fs.makedir('newdir')
+        self.assertFalse(
+            self.fs._missing_get('/newdir', ResourceType.directory))
+        self.assertTrue(self.fs.isdir('newdir'))
+
+        self.assertFalse(self.fs.exists('newfile'))
+        self.assertTrue(self.fs._missing_get('/newfile', ResourceType.file))
+        self.fs.writebytes('newfile', b'data')
+        self.assertFalse(self.fs._missing_get('/newfile', ResourceType.file))
+        self.assertTrue(self.fs.isfile('newfile'))
+        self.assertEqual(self.fs.readbytes('newfile'), b'data')
+
+    def test_stale_cache_getinfo(self):
+        # Paths changed by another client are still in this fs's cache
+        ns = str(uuid4())
+        fs1 = OmeroFS(conn=self.conn, ns=ns, cache_ttl=60)
+        self.addCleanup(fs1.close)
+        fs2 = OmeroFS(conn=self.conn, ns=ns)
+        self.addCleanup(fs2.close)
+
+        fs1.writebytes('file', b'data')
+        fs2.remove('file')
+        with self.assertRaises(errors.ResourceNotFound):
+            fs1.getinfo('file')
+        self.assertFalse(fs1.exists('file'))
+
+        fs1.writebytes('type', b'data')
+        self.assertFalse(fs1.isdir('type'))
+        fs2.remove('type')
+        fs2.makedir('type')
+        self.assertTrue(fs1.getinfo('type').is_dir)
+        self.assertTrue(fs1.isdir('type'))
+
+    def test_cache_size(self):
+        fs = OmeroFS(conn=self.conn, ns=str(uuid4()), cache_ttl=60,
+                     cache_size=2)
+        self.addCleanup(fs.close)
+        for name in ('a', 'b', 'c'):
+            fs.makedir(name)
+        self.assertEqual(len(fs.path_cache), 2)
+        self.assertIn('/c', fs.path_cache)
+        self.assertNotIn('/a', fs.path_cache)
+        # Evicted paths are looked up again
+        self.assertTrue(fs.isdir('a'))
+        self.assertIn('/a', fs.path_cache)
+        self.assertEqual(len(fs.path_cache), 2)
+
+    def test_walk_batched(self):
+        # fs.walk lists several directories per query with OmeroWalker,
+        # check it walks the same paths as the default walker
+        mem = MemoryFS()
+        self.addCleanup(mem.close)
+        for fs in (self.fs, mem):
+            for path in ('a/b/c/d', 'a/x/y', 'e'):
+                fs.makedirs(path)
+            for path in ('1', 'a/2', 'a/b/3', 'a/b/c/4', 'a/b/c/d/5',
+                         'a/x/6', 'a/x/y/7'):
+                fs.writebytes(path, b'')
+        for kwargs in (
+                {},
+                {'max_depth': 2},
+                {'exclude_dirs': ['x']},
+                {'max_depth': 3, 'exclude_dirs': ['b']},
+                {'filter_dirs': ['a', 'b']},
+                {'search': 'depth', 'max_depth': 3},
+                {'search': 'depth', 'exclude_dirs': ['c']}):
+            for path in ('/', '/a'):
+                with mock.patch.object(
+                        self.fs, '_qs', wraps=self.fs._qs) as qs:
+                    self.assertEqual(
+                        sorted(self.fs.walk.files(path, **kwargs)),
+                        sorted(mem.walk.files(path, **kwargs)))
+                    self.assertEqual(
+                        sorted(self.fs.walk.dirs(path, **kwargs)),
+                        sorted(mem.walk.dirs(path, **kwargs)))
+                queries = set(c[0][0] for c in qs.projection.call_args_list)
+                self.assertIn(fsmod._Q_WALK_DIRS, queries)
+                self.assertIn(fsmod._Q_WALK_FILES, queries)
+                self.assertNotIn(fsmod._Q_LIST_DIRS_INFO, queries)
+                self.assertNotIn(fsmod._Q_LIST_FILES_INFO, queries)
+
+    def test_walk_interleaved(self):
+        for path in ('a/b/c', 'd/e'):
+            self.fs.makedirs(path)
+        walker = OmeroWalker()
+        outer = walker.dirs(self.fs, '/a')
+        self.assertEqual(next(outer), '/a/b')
+        self.assertEqual(list(walker.dirs(self.fs, '/d')), ['/d/e'])
+        self.assertEqual(list(outer), ['/a/b/c'])
+
+    def test_threaded_create(self):
+        # Threads opening the same new file or directory only create it once
+        def create(n):
+            with self.fs.openbin('new', 'w') as f:
+                f.write(b'data')
+            self.fs.makedir('newdir', recreate=True)
+
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(create, range(16)))
+        self.assertEqual(sorted(self.fs.listdir('/')), ['new', 'newdir'])
+        self.assertEqual(self.fs.readbytes('new'), b'data')
+
+    def test_open_deleted_cached_file(self):
+        # A file deleted by another client is still in this fs's cache
+        ns = str(uuid4())
+        fs1 = OmeroFS(conn=self.conn, ns=ns, cache_ttl=60)
+        self.addCleanup(fs1.close)
+        fs2 = OmeroFS(conn=self.conn, ns=ns)
+        self.addCleanup(fs2.close)
+
+        fs1.writebytes('file', b'data')
+        fs2.remove('file')
+        with self.assertRaises(errors.ResourceNotFound):
+            fs1.openbin('file')
+
+        fs1.writebytes('file', b'data')
+        fs2.remove('file')
+        fs1.writebytes('file', b'new')
+        self.assertEqual(fs2.readbytes('file'), b'new')
+
+    def test_credentials(self):
+        # Connect and create a session instead of using the shared one
+        fs = OmeroFS(host='localhost', user='root', passwd='omero',
+                     ns=str(uuid4()))
+        self.addCleanup(fs.close)
+        fs.makedir('dir')
+        fs.writebytes('dir/file', b'data')
+        self.assertEqual(fs.readbytes('dir/file'), b'data')
+        self.assertEqual(fs.listdir('/'), ['dir'])
+
+    def test_removetree_many(self):
+        # More children than fit in one page of a directory listing
+        self.fs.makedir('big')
+        for n in range(600):
+            self.fs.create('big/{}'.format(n))
+        self.fs.removetree('big')
+        self.assertFalse(self.fs.exists('big'))
+
+    def test_create_missing_cached(self):
+        # A file created by another client is in this fs's negative cache
+        ns = str(uuid4())
+        fs1 = OmeroFS(conn=self.conn, ns=ns, cache_ttl=60)
+        self.addCleanup(fs1.close)
+        fs2 = OmeroFS(conn=self.conn, ns=ns)
+        self.addCleanup(fs2.close)
+
+        self.assertFalse(fs1.exists('x'))
+        fs2.create('x')
+        with self.assertRaises(errors.FileExists):
+            fs1.openbin('x', 'x')
+
+        self.assertFalse(fs1.exists('w'))
+        fs2.writebytes('w', b'data')
+        fs1.writebytes('w', b'new')
+        self.assertEqual(sorted(fs2.listdir('/')), ['w', 'x'])
+        self.assertEqual(fs2.readbytes('w'), b'new')
+
+    def test_makedir_file_parent(self):
+        # The parent isn't checked for a file to save a query
+        self.fs.writebytes('file.txt', b'data')
+        with self.assertRaises(errors.ResourceNotFound):
+            self.fs.makedir('file.txt/sub')
+
+
+class TestSessionPool(unittest.TestCase):
+    # Unit tests for the session pool, these don't need a server
+
+    def setUp(self):
+        patches = [
+            mock.patch('fs_omero_pyfs.fs.omero.client'),
+            mock.patch('fs_omero_pyfs.fs.BlitzGateway'),
+            mock.patch('fs_omero_pyfs.fs.SESSION_POOL_TTL', 300),
+            mock.patch.dict('fs_omero_pyfs.fs._SESSION_POOL', clear=True),
+        ]
+        self.client, self.gateway = [p.start() for p in patches][:2]
+        for p in reversed(patches):
+            self.addCleanup(p.stop)
+        self.gateway.side_effect = lambda client_obj: mock.MagicMock()
+        self.addCleanup(self.cancel_timer)
+
+    def cancel_timer(self):
+        if fsmod._SESSION_POOL_TIMER:
+            fsmod._SESSION_POOL_TIMER.cancel()
+            fsmod._SESSION_POOL_TIMER = None
+
+    def acquire(self, passwd='omero', keepalive=60):
+        return fsmod._acquire_session(
+            'localhost', 'root', passwd, None, keepalive)
+
+    def test_shared(self):
+        a = self.acquire()
+        b = self.acquire()
+        self.assertIs(a, b)
+        self.assertEqual(a.refcount, 2)
+        self.assertEqual(self.client.call_count, 1)
+        self.client.return_value.enableKeepAlive.assert_called_once_with(60)
+        # The password isn't kept
+        self.assertNotIn('omero', a.key)
+
+    def test_key(self):
+        a = self.acquire()
+        self.assertIsNot(a, self.acquire(passwd='other'))
+        self.assertIsNot(a, self.acquire(keepalive=0))
+        self.assertEqual(self.client.call_count, 3)
+
+    def test_release(self):
+        a = self.acquire()
+        fsmod._release_session(a)
+        self.assertEqual(a.refcount, 0)
+        # Idle sessions are reused until they expire
+        self.assertIs(self.acquire(), a)
+        fsmod._release_session(a)
+        with mock.patch('fs_omero_pyfs.fs.SESSION_POOL_TTL', 0):
+            fsmod._release_session(self.acquire())
+        a.conn.close.assert_called_once_with()
+        self.assertEqual(fsmod._SESSION_POOL, {})
+
+    def test_dead_session_replaced(self):
+        a = self.acquire()
+        fsmod._release_session(a)
+        a.conn.keepAlive.return_value = False
+        b = self.acquire()
+        self.assertIsNot(a, b)
+        a.conn.close.assert_called_once_with()
+
+    def test_dead_session_acquired_during_check(self):
+        a = self.acquire()
+        fsmod._release_session(a)
+        acquired = []
+
+        def keepalive():
+            # Another filesystem gets the session while it's checked
+            acquired.append(self.acquire())
+            return False
+        a.conn.keepAlive.side_effect = keepalive
+        b = self.acquire()
+        self.assertEqual(acquired, [a])
+        self.assertIsNot(a, b)
+        self.assertNotIn(a, fsmod._SESSION_POOL.values())
+        self.assertIs(self.acquire(), b)
+        a.conn.close.assert_called_once_with()
+
+    def test_timer_eviction(self):
+        with mock.patch('fs_omero_pyfs.fs.SESSION_POOL_TTL', 0.1):
+            a = self.acquire()
+            fsmod._release_session(a)
+            self.assertIn(a.key, fsmod._SESSION_POOL)
+            for n in range(50):
+                if a.conn.close.called:
+                    break
+                sleep(0.1)
+        a.conn.close.assert_called_once_with()
+        self.assertEqual(fsmod._SESSION_POOL, {})
+
+    def test_init_failure_releases(self):
+        def gateway(client_obj):
+            conn = mock.MagicMock()
+            conn.getQueryService.side_effect = RuntimeError('failed')
+            return conn
+        self.gateway.side_effect = gateway
+        with self.assertRaises(errors.RemoteConnectionError):
+            OmeroFS(host='localhost', user='root', passwd='omero')
+        pooled, = fsmod._SESSION_POOL.values()
+        self.assertEqual(pooled.refcount, 0)
+
+    def test_missing_credentials(self):
+        with self.assertRaises(ValueError):
+            OmeroFS(host='localhost', user='root')
+        self.assertEqual(self.client.call_count, 0)
+
+
+class TestOriginalFileObj(unittest.TestCase):
+
+    def test_missing_file_closes_store(self):
+        conn = mock.MagicMock()
+        rfs = conn.c.sf.createRawFileStore.return_value
+        rfs.setFileId.side_effect = RuntimeError('file not found')
+        try:
+            OriginalFileObj(FileRef(conn, 1))
+        except RuntimeError:
+            # The object is still referenced by the traceback here so it
+            # can't have been closed when it was garbage collected
+            rfs.close.assert_called_once_with()
+        else:
+            self.fail('RuntimeError not raised')